@@ -32,10 +32,11 @@ if not TELEGRAM_TOKEN:
 
 # Allowed Telegram User IDs from environment variable
 ALLOWED_USER_IDS_STR = os.getenv("ALLOWED_USER_IDS")
-ALLOWED_USER_IDS = []
+# Stored as a frozenset: is_allowed_user checks membership on every incoming update
+ALLOWED_USER_IDS = frozenset()
 if ALLOWED_USER_IDS_STR:
     try:
-        ALLOWED_USER_IDS = [int(uid.strip()) for uid in ALLOWED_USER_IDS_STR.split(',')]
+        ALLOWED_USER_IDS = frozenset(int(uid.strip()) for uid in ALLOWED_USER_IDS_STR.split(','))
     except ValueError:
         logger.error(f"Invalid format for ALLOWED_USER_IDS: '{ALLOWED_USER_IDS_STR}'. Expected comma-separated integers.")
 else:
@@ -58,19 +59,28 @@ logging.basicConfig(
 # ---- Initialize Google Credentials ----
 # This is kept separate to allow other modules to import config values
 # without immediately trying to load credentials if they are not needed.
+# Successfully loaded credentials, kept for the lifetime of the process (including warm Lambda containers).
+_credentials = None
+
 def get_google_credentials():
     """
     Loads Google service account credentials from the path specified
     in the GOOGLE_SERVICE_ACCOUNT_PATH environment variable.
+    Only a successful load is cached (the Credentials object refreshes its own access token,
+    so one instance stays valid); after a failure, the next call tries loading again.
     """
+    global _credentials
+    if _credentials is not None:
+        return _credentials
     if not SERVICE_ACCOUNT_FILE_PATH:
         logger.error("Cannot load Google credentials: GOOGLE_SERVICE_ACCOUNT_PATH is not set.")
         return None
     try:
-        return Credentials.from_service_account_file(
+        _credentials = Credentials.from_service_account_file(
             SERVICE_ACCOUNT_FILE_PATH,
             scopes=SCOPES
         )
+        return _credentials
     except FileNotFoundError:
         logger.error(f"Service account file not found at: {SERVICE_ACCOUNT_FILE_PATH}")
         return None
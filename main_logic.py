@@ -1,23 +1,31 @@
+import asyncio
 from datetime import datetime
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import ChatAction
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
-from PIL import Image, ImageDraw, ImageFont
 import io
 import logging
+import threading
+import zlib
 import gspread 
 import os
+import re
+import struct
 from config import ALLOWED_USER_IDS, FONT_PATH
 from sheet import (
     find_client_credits, get_credit_data, log_payment_and_update_credit,
-    find_first_empty_log_row, connect_to_sheet 
+    connect_to_sheet, MasterUpdateError
 )
 
 # ---- Logger setup ----
 logger = logging.getLogger(__name__)
 
+# Callback data format: "select_{row_index}_{num_cuotas}_{item_code}"
+_CALLBACK_DATA_RE = re.compile(r"^select_(\d+)_(\d+)_(.+)$")
+
 # ---- Helper Functions ----
-async def is_allowed_user(update: Update) -> bool:
-    """Checks if the user interacting with the bot is in the ALLOWED_USER_IDS list."""
+def is_allowed_user(update: Update) -> bool:
+    """Checks if the user interacting with the bot is in the ALLOWED_USER_IDS set."""
     user = update.effective_user
     if not user:
         logger.warning("Attempted interaction from a user with no effective_user object.")
@@ -31,108 +39,343 @@ async def is_allowed_user(update: Update) -> bool:
     return is_auth
 
 
-def generate_ticket_image(ticket_text: str) -> io.BytesIO:
+# ---- Bundled Fonts ----
+# Last-resort TrueType fonts shipped with the code (fonts/), so a misconfigured FONT_PATH
+# still renders with predictable glyphs instead of PIL's basic default font.
+BUNDLED_FONT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fonts")
+
+# ---- Font Cache ----
+# Truetype faces are expensive to build, so the fallback chain below runs only once
+# and every ticket reuses the resulting (bold, regular) pair.
+_fonts = None
+_fonts_lock = threading.Lock()
+
+def _get_fonts() -> tuple:
     """
-    Generates a PNG image of a payment ticket from the provided text.
-    
-    Args:
-        ticket_text: A string containing the formatted ticket information.
-                     Lines starting with "**" and ending with "**" (or just starting with "**")
-                     will be rendered in bold.
-                     
-    Returns:
-        An io.BytesIO object containing the PNG image data.
+    Returns the cached (font_bold, font_regular) tuple, loading it on first use.
     """
-    width, height = 600, 900  # Dimensions of the ticket image
-    bg_color = (255, 255, 255)  # White background
-    text_color = (0, 0, 0)    # Black text
-    image = Image.new("RGB", (width, height), bg_color)
-    draw = ImageDraw.Draw(image)
+    global _fonts
+    if _fonts is not None:
+        return _fonts
 
-    # Font loading with fallback
-    # FONT_PATH is configured in config.py, sourced from environment variable
-    # Ensure arialbd.ttf (bold) and arial.ttf (regular) are in that path
-    # or update with your desired font names.
-    try:
-        font_bold_path = os.path.join(FONT_PATH, "arialbd.ttf")
-        font_regular_path = os.path.join(FONT_PATH, "arial.ttf")
-        font_bold = ImageFont.truetype(font_bold_path, 24)
-        font_regular = ImageFont.truetype(font_regular_path, 22)
-        logger.debug(f"Successfully loaded fonts: Bold='{font_bold_path}', Regular='{font_regular_path}'")
-    except IOError:
-        logger.warning(
-            f"Arial fonts not found in '{FONT_PATH}'. Trying Courier fallback. "
-            "Place 'arial.ttf' and 'arialbd.ttf' in the FONT_PATH directory for optimal results."
-        )
+    with _fonts_lock:
+        if _fonts is not None: # Another thread may have loaded them while we waited
+            return _fonts
+
+        from PIL import ImageFont # Imported lazily to keep Pillow out of the cold start
+
+        # Font loading with fallback
+        # FONT_PATH is configured in config.py, sourced from environment variable
+        # Ensure arialbd.ttf (bold) and arial.ttf (regular) are in that path
+        # or update with your desired font names.
         try:
-            font_bold_path = os.path.join(FONT_PATH, "courbd.ttf") # Courier Bold
-            font_regular_path = os.path.join(FONT_PATH, "cour.ttf") # Courier Regular
+            font_bold_path = os.path.join(FONT_PATH, "arialbd.ttf")
+            font_regular_path = os.path.join(FONT_PATH, "arial.ttf")
             font_bold = ImageFont.truetype(font_bold_path, 24)
             font_regular = ImageFont.truetype(font_regular_path, 22)
-            logger.debug(f"Successfully loaded Courier fonts: Bold='{font_bold_path}', Regular='{font_regular_path}'")
+            logger.debug(f"Successfully loaded fonts: Bold='{font_bold_path}', Regular='{font_regular_path}'")
         except IOError:
-            logger.error(
-                f"Courier fonts also not found in '{FONT_PATH}'. Using default PIL font. Ticket appearance will be basic."
+            logger.warning(
+                f"Arial fonts not found in '{FONT_PATH}'. Trying Courier fallback. "
+                "Place 'arial.ttf' and 'arialbd.ttf' in the FONT_PATH directory for optimal results."
             )
-            font_bold = ImageFont.load_default()
-            font_regular = ImageFont.load_default()
+            try:
+                font_bold_path = os.path.join(FONT_PATH, "courbd.ttf") # Courier Bold
+                font_regular_path = os.path.join(FONT_PATH, "cour.ttf") # Courier Regular
+                font_bold = ImageFont.truetype(font_bold_path, 24)
+                font_regular = ImageFont.truetype(font_regular_path, 22)
+                logger.debug(f"Successfully loaded Courier fonts: Bold='{font_bold_path}', Regular='{font_regular_path}'")
+            except IOError:
+                logger.warning(f"Courier fonts also not found in '{FONT_PATH}'. Using bundled DejaVu Sans fonts.")
+                try:
+                    font_bold_path = os.path.join(BUNDLED_FONT_PATH, "DejaVuSans-Bold.ttf")
+                    font_regular_path = os.path.join(BUNDLED_FONT_PATH, "DejaVuSans.ttf")
+                    font_bold = ImageFont.truetype(font_bold_path, 24)
+                    font_regular = ImageFont.truetype(font_regular_path, 22)
+                    logger.debug(f"Successfully loaded bundled fonts: Bold='{font_bold_path}', Regular='{font_regular_path}'")
+                except IOError:
+                    logger.error(
+                        f"Bundled fonts not found in '{BUNDLED_FONT_PATH}'. Using default PIL font. Ticket appearance will be basic."
+                    )
+                    font_bold = ImageFont.load_default()
+                    font_regular = ImageFont.load_default()
+
+        _fonts = (font_bold, font_regular)
+    return _fonts
+
+
+# ---- Ticket Template ----
+# Using the client's format as a simple and complete example, suitable for modifications including
+# adding a business logo and/or other embedded graphic content.
+# Each entry is a (use_bold_font, format_string) line. Everything outside the {placeholders} is static and
+# gets rendered only once (see _get_ticket_template), placeholders are filled from the dict passed to
+# generate_ticket_image.
+TICKET_SEPARATOR = "------------------------------------------"
+TICKET_STAR_SEPARATOR = "******************************"
+TICKET_LINES = [
+    (True, "Comprobante de Pago"),
+    (False, ""),
+    (False, ""),
+    (True, "Fecha: {fecha}"),
+    (False, ""),
+    (True, "Cliente: {nombre} {apellido}"),
+    (True, "Comercio: {local_comercial}"),
+    (True, "Dirección: {direccion}"),
+    (False, TICKET_SEPARATOR),
+    (False, ""),
+    (True, "IMPORTE POR CUOTA: ${importe_cuota:,.2f}"), # Format currency
+    (True, "CUOTAS PAGADAS HOY: {cuotas_a_pagar}"),
+    (True, "ARTÍCULO: {articulo} (Código: {codigo})"),
+    (True, "PAGO DE CUOTAS NRO: {rango_cuotas_pagadas}"),
+    (True, "SALDO PAGADO TOTAL: ${saldo_pagado_total:,.2f} de ${total_credito:,.2f}"),
+    (True, "REMITO Nro: {remito}"),
+    (False, TICKET_SEPARATOR),
+    (False, ""),
+    (True, "TOTAL PAGADO HOY: ${total_pagado_hoy:,.2f}"),
+    (True, "COBRADOR: {cobrador}"),
+    (False, ""),
+    (False, "Exija y conserve este comprobante de pago."),
+    (True, TICKET_STAR_SEPARATOR),
+    (False, ""),
+    (True, "¡ATENCIÓN!"),
+    (False, "- Los pagos se realizan de Lunes a Sábado,"),
+    (False, "y feriados inclusive."),
+    (True, TICKET_STAR_SEPARATOR),
+]
+
+TICKET_WIDTH, TICKET_HEIGHT = 600, 900  # Dimensions of the ticket image
+TICKET_LINE_GAP = 5  # Leading added below each line's text height (32px lines with 24px Arial Bold)
+# Tickets are black text on white, so they are rendered in 8-bit grayscale ("L"):
+# a third of the RGB buffer size through drawing, copying and PNG encoding.
+TICKET_IMAGE_MODE = "L"
+TICKET_BG_COLOR = 255  # White background
+TICKET_TEXT_COLOR = 0    # Black text
+TICKET_ERROR_COLOR = 128  # Gray, for the in-image error notice
+
+_ticket_template = None
+_ticket_template_lock = threading.Lock()
+
+def _build_ticket_template() -> tuple:
+    """
+    Renders the static text of TICKET_LINES into a background image.
+
+    Returns:
+        A (template_image, dynamic_fields) tuple. Each dynamic field is an
+        (x, y, format_string, use_bold_font) entry describing where the rest of
+        a line, from its first placeholder onwards, must be drawn.
+    """
+    from PIL import Image, ImageDraw
+
+    image = Image.new(TICKET_IMAGE_MODE, (TICKET_WIDTH, TICKET_HEIGHT), TICKET_BG_COLOR)
+    draw = ImageDraw.Draw(image)
+    font_bold, font_regular = _get_fonts()
+    dynamic_fields = []
 
     y_text_start = 25  # Initial Y position for text
-    line_spacing = 32  # Space between lines
     current_y = y_text_start
     margin_x = 25
 
-    for line in ticket_text.split("\n"):
-        text_to_draw = line.strip()
-        use_bold_font = False
+    # Space between lines, per font: its real text height ("Hg" spans ascender to descender) plus some leading.
+    # Measured once here instead of a fixed 32px, which only suited the 24/22px Arial pair.
+    line_spacing_bold = font_bold.getbbox("Hg")[3] + TICKET_LINE_GAP
+    line_spacing_regular = font_regular.getbbox("Hg")[3] + TICKET_LINE_GAP
+
+    # Consecutive plain lines (regular font, no placeholders, no separators) are drawn together
+    # with a single multiline_text call. Pillow spaces multiline text by the height of "A" plus
+    # `spacing`, so pick the spacing that keeps the same line_spacing_regular as individual lines.
+    text_block, text_block_y = [], current_y
+    text_block_spacing = line_spacing_regular - font_regular.getbbox("A")[3]
+
+    def _flush_text_block():
+        if text_block:
+            draw.multiline_text(
+                (margin_x, text_block_y), "\n".join(text_block),
+                fill=TICKET_TEXT_COLOR, font=font_regular, spacing=text_block_spacing
+            )
+            text_block.clear()
 
-        if text_to_draw.startswith("**") and text_to_draw.endswith("**"):
-            use_bold_font = True
-            text_to_draw = text_to_draw[2:-2] # Remove double asterisks
-        elif text_to_draw.startswith("**"): # For lines like "**HEADER"
-            use_bold_font = True
-            text_to_draw = text_to_draw[2:]
+    for use_bold_font, line_format in TICKET_LINES:
+        is_separator = line_format in (TICKET_SEPARATOR, TICKET_STAR_SEPARATOR)
+        line_spacing = line_spacing_bold if use_bold_font else line_spacing_regular
 
-        current_font_to_use = font_bold if use_bold_font else font_regular
-        
-        try:
-            draw.text((margin_x, current_y), text_to_draw, fill=text_color, font=current_font_to_use)
-        except Exception as e:
-            error_msg = f"Error drawing text line: '{text_to_draw[:50]}...'"
-            logger.error(f"{error_msg}: {e}", exc_info=True)
-            # Draw an error message on the image itself for this line
-            draw.text((margin_x, current_y), "[Error rendering this line]", fill=(255,0,0), font=font_regular)
+        if not use_bold_font and line_format and not is_separator and "{" not in line_format:
+            if not text_block:
+                text_block_y = current_y
+            text_block.append(line_format)
+        else:
+            _flush_text_block()
+            text_to_draw = line_format
+            current_font_to_use = font_bold if use_bold_font else font_regular
+
+            # Split the line at its first placeholder: the prefix is static, the remainder is per ticket
+            placeholder_pos = text_to_draw.find("{")
+            if placeholder_pos != -1:
+                static_text = text_to_draw[:placeholder_pos]
+                field_x = margin_x + current_font_to_use.getlength(static_text)
+                dynamic_fields.append((field_x, current_y, text_to_draw[placeholder_pos:], use_bold_font))
+                text_to_draw = static_text
 
+            if text_to_draw:
+                draw.text((margin_x, current_y), text_to_draw, fill=TICKET_TEXT_COLOR, font=current_font_to_use)
 
         # Adjust spacing based on line content
-        if line.strip().startswith("-----") or line.strip().startswith("*****"):
+        if is_separator:
             current_y += line_spacing * 0.7  # Reduced spacing for separators
-        elif not line.strip(): # Empty line
+        elif not line_format: # Empty line
             current_y += line_spacing * 0.5  # Reduced spacing for empty lines
         else:
             current_y += line_spacing
 
-        if current_y > height - 30: # Check if text exceeds image height
+        if current_y > TICKET_HEIGHT - 30: # Check if text exceeds image height
             logger.warning("Ticket content exceeds image height. Truncating.")
-            draw.text((margin_x, current_y), "...", fill=text_color, font=font_regular)
+            draw.text((margin_x, current_y), "...", fill=TICKET_TEXT_COLOR, font=font_regular)
             break
+    _flush_text_block()
+
+    # Crop the unused bottom of the canvas: fewer pixels to copy, encode and upload per ticket
+    content_height = min(TICKET_HEIGHT, int(current_y) + 20)
+    image = image.crop((0, 0, TICKET_WIDTH, content_height))
+
+    logger.debug(f"Ticket template rendered with {len(dynamic_fields)} dynamic field(s).")
+    return image, dynamic_fields
+
+
+def _get_ticket_template() -> tuple:
+    """Returns the cached (template_image, dynamic_fields) tuple, rendering it on first use."""
+    global _ticket_template
+    if _ticket_template is not None:
+        return _ticket_template
+
+    with _ticket_template_lock:
+        if _ticket_template is None:
+            _ticket_template = _build_ticket_template()
+    return _ticket_template
+
+
+# ---- Glyph Atlas ----
+# Rasterized masks for the characters used by the dynamic ticket fields, keyed by (font id, char).
+# Pasting a cached mask is much cheaper than running draw.text (shaping + rasterizing) on every ticket.
+# Glyphs are added lazily, which also covers accented characters (e.g. "Pérez", "Ñandú").
+_glyph_atlas = {}
+# Line breaks, tabs and other control characters (e.g. an Alt+Enter inside a sheet cell) have no glyph:
+# getbbox gives them the .notdef box. Each run of them, with any surrounding whitespace, becomes one space.
+_CONTROL_CHARS_RE = re.compile(r"\s*[\x00-\x1f\x7f-\x9f\u2028\u2029][\s\x00-\x1f\x7f-\x9f\u2028\u2029]*")
+
+def _get_glyph(font, char: str) -> tuple:
+    """Returns the cached (mask, offset, advance) entry for `char`, rasterizing it on first use."""
+    key = (id(font), char)
+    glyph = _glyph_atlas.get(key)
+    if glyph is None:
+        left, top, right, bottom = font.getbbox(char)
+        mask = None
+        if right > left and bottom > top: # Whitespace has no pixels, only an advance
+            from PIL import Image, ImageDraw
+            mask = Image.new("L", (right - left, bottom - top), 0)
+            ImageDraw.Draw(mask).text((-left, -top), char, fill=255, font=font)
+        glyph = (mask, (left, top), font.getlength(char))
+        _glyph_atlas[key] = glyph
+    return glyph
+
+
+def _draw_text_from_atlas(image, position: tuple, text: str, font, fill) -> None:
+    """Draws `text` on `image` one cached glyph at a time, starting at `position`, as a single line."""
+    text = _CONTROL_CHARS_RE.sub(" ", text)
+    x, y = position
+    for char in text:
+        mask, (offset_x, offset_y), advance = _get_glyph(font, char)
+        if mask is not None:
+            image.paste(fill, (round(x + offset_x), round(y + offset_y)), mask)
+        x += advance
+
+
+# ---- Image Buffer ----
+# One PNG output buffer per thread, reused across tickets instead of allocating a new one each time.
+_thread_local = threading.local()
+
+def _get_image_buffer() -> io.BytesIO:
+    """Returns this thread's reusable image buffer, emptied and rewound."""
+    img_buffer = getattr(_thread_local, "img_buffer", None)
+    if img_buffer is None:
+        img_buffer = _thread_local.img_buffer = io.BytesIO()
+    else:
+        img_buffer.seek(0)
+        img_buffer.truncate(0)
+    return img_buffer
+
+
+# ---- PNG Encoding ----
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+def _write_png_chunk(buffer: io.BytesIO, chunk_type: bytes, data: bytes) -> None:
+    """Writes one length-prefixed, CRC-terminated PNG chunk to `buffer`."""
+    buffer.write(struct.pack(">I", len(data)))
+    buffer.write(chunk_type)
+    buffer.write(data)
+    buffer.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(chunk_type))))
+
+
+def _encode_gray_png(buffer: io.BytesIO, width: int, height: int, pixels: bytes) -> None:
+    """
+    Encodes 8-bit grayscale `pixels` (as returned by Image.tobytes() for an "L" image) as PNG into `buffer`.
+    Tickets always have the same simple shape, so this skips Pillow's generic PNG plugin:
+    one IHDR, a single IDAT (no scanline filtering, fastest deflate level) and IEND.
+    """
+    # Every scanline is prefixed with its filter type byte (0 = None)
+    scanlines = b"".join(b"\x00" + pixels[row:row + width] for row in range(0, width * height, width))
+    buffer.write(_PNG_SIGNATURE)
+    # Width, height, bit depth 8, color type 0 (grayscale), default compression/filter, no interlace
+    _write_png_chunk(buffer, b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0))
+    _write_png_chunk(buffer, b"IDAT", zlib.compress(scanlines, 1))
+    _write_png_chunk(buffer, b"IEND", b"")
+
+
+def generate_ticket_image(ticket_fields: dict) -> bytes:
+    """
+    Generates a PNG image of a payment ticket by filling the pre-rendered
+    TICKET_LINES template with the provided values.
+    
+    Args:
+        ticket_fields: A dict with a value for every placeholder in TICKET_LINES
+                       (fecha, nombre, apellido, importe_cuota, remito, etc.).
+                     
+    Returns:
+        The PNG image data as bytes.
+    """
+    template_image, dynamic_fields = _get_ticket_template()
+    image = template_image.copy()
+    font_bold, font_regular = _get_fonts()
+
+    for field_x, field_y, field_format, use_bold_font in dynamic_fields:
+        current_font_to_use = font_bold if use_bold_font else font_regular
+        try:
+            text_to_draw = field_format.format_map(ticket_fields).strip()
+            _draw_text_from_atlas(image, (field_x, field_y), text_to_draw, current_font_to_use, TICKET_TEXT_COLOR)
+        except Exception as e:
+            error_msg = f"Error drawing ticket field: '{field_format[:50]}...'"
+            logger.error(f"{error_msg}: {e}", exc_info=True)
+            # Draw an error message on the image itself for this field
+            from PIL import ImageDraw
+            ImageDraw.Draw(image).text((field_x, field_y), "[Error rendering this line]", fill=TICKET_ERROR_COLOR, font=font_regular)
             
-    img_buffer = io.BytesIO()
-    image.save(img_buffer, format="PNG")
-    img_buffer.seek(0) # Rewind buffer to the beginning
+    img_buffer = _get_image_buffer()
+    # Tickets are small and mostly white, so the fastest deflate level costs little in size
+    if image.mode == "L":
+        _encode_gray_png(img_buffer, image.width, image.height, image.tobytes())
+    else:
+        image.save(img_buffer, format="PNG", compress_level=1)
     logger.info("Payment ticket image generated successfully.")
-    return img_buffer
+    return img_buffer.getvalue()
 
 
 # ---- Bot Command Handlers ----
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handles the /start command. Greets authorized users."""
-    if not await is_allowed_user(update):
+    if not is_allowed_user(update):
         await update.message.reply_text("⛔ Access Denied. You are not authorized to use this bot.")
         return
 
     # Check Google Sheet connectivity on start (optional, but good for early feedback)
-    sheet_conn = connect_to_sheet()
+    sheet_conn = await asyncio.to_thread(connect_to_sheet)
     if not sheet_conn:
         logger.critical(f"User {update.effective_user.id} issued /start, but Google Sheets connection failed.")
         await update.message.reply_text(
@@ -155,7 +398,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 
 async def process_payment_request(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Processes incoming text messages to identify payment registration requests."""
-    if not await is_allowed_user(update):
+    if not is_allowed_user(update):
         # Silently ignore or reply with access denied, depending on desired behavior
         # await update.message.reply_text("⛔ Access Denied.")
         return
@@ -187,7 +430,14 @@ async def process_payment_request(update: Update, context: ContextTypes.DEFAULT_
     logger.info(f"User {user_id} requested payment registration for: {nombre} {apellido}, Installments: {num_cuotas}")
 
     try:
-        client_credits = find_client_credits(nombre, apellido)
+        # The Sheets lookup is blocking network I/O: run it in a worker thread so the event loop stays free,
+        # and show the "typing..." indicator while it is in flight.
+        credits_task = asyncio.create_task(asyncio.to_thread(find_client_credits, nombre, apellido))
+        try:
+            await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
+        except Exception as e: # Cosmetic only, never block the lookup on it
+            logger.warning(f"Could not send typing action to user {user_id}: {e}")
+        client_credits = await credits_task
         if not client_credits:
             logger.info(f"No active credits found for {nombre} {apellido} (User: {user_id}).")
             await update.message.reply_text(
@@ -199,18 +449,20 @@ async def process_payment_request(update: Update, context: ContextTypes.DEFAULT_
 
         logger.info(f"Found {len(client_credits)} credit(s) for {nombre} {apellido}. Presenting options to user {user_id}.")
         
-        keyboard_buttons = []
         response_text = (
             f"📄 Found {len(client_credits)} item(s) for **{nombre} {apellido}**.\n"
             f"Please select the item for which to register **{num_cuotas}** installment(s):\n"
         )
 
-        for credit_match in client_credits:
-            # Callback data format: "select_{row_index}_{num_cuotas}_{item_code}"
-            # Item code added for potential display in processing message.
-            callback_data = f"select_{credit_match['row_index']}_{num_cuotas}_{credit_match['codigo']}"
-            button_label = f"{credit_match['articulo']} (Code: {credit_match['codigo']})"
-            keyboard_buttons.append([InlineKeyboardButton(button_label, callback_data=callback_data)])
+        # Callback data format: "select_{row_index}_{num_cuotas}_{item_code}"
+        # Item code added for potential display in processing message.
+        keyboard_buttons = [
+            [InlineKeyboardButton(
+                f"{credit_match['articulo']} (Code: {credit_match['codigo']})",
+                callback_data=f"select_{credit_match['row_index']}_{num_cuotas}_{credit_match['codigo']}"
+            )]
+            for credit_match in client_credits
+        ]
         
         reply_markup = InlineKeyboardMarkup(keyboard_buttons)
         await update.message.reply_text(response_text, reply_markup=reply_markup, parse_mode='Markdown')
@@ -231,7 +483,7 @@ async def handle_item_selection_callback(update: Update, context: ContextTypes.D
     query = update.callback_query
     await query.answer() # Acknowledge the callback query
 
-    if not await is_allowed_user(update):
+    if not is_allowed_user(update):
         logger.warning(f"Unauthorized callback query attempt by user {update.effective_user.id if update.effective_user else 'Unknown'}.")
         try:
             await query.edit_message_text("⛔ Access Denied. You are not authorized for this action.")
@@ -244,17 +496,18 @@ async def handle_item_selection_callback(update: Update, context: ContextTypes.D
     logger.info(f"User {user_id} selected item via callback: {callback_data_str}")
 
     try:
-        action, row_index_str, cuotas_a_pagar_str, item_code_str = callback_data_str.split('_', 3)
-        if action != "select":
-            raise ValueError("Invalid callback action.")
-        
-        row_index = int(row_index_str)
-        cuotas_a_pagar = int(cuotas_a_pagar_str)
+        callback_match = _CALLBACK_DATA_RE.match(callback_data_str)
+        if not callback_match:
+            raise ValueError("Invalid callback action or format.")
+
+        row_index = int(callback_match.group(1))
+        cuotas_a_pagar = int(callback_match.group(2))
+        item_code_str = callback_match.group(3)
 
         if not (row_index > 1 and cuotas_a_pagar > 0): 
              raise ValueError("Invalid row index or number of installments from callback.")
 
-    except (ValueError, IndexError) as e:
+    except ValueError as e:
         logger.error(f"Error parsing callback data '{callback_data_str}' for user {user_id}: {e}", exc_info=True)
         await query.edit_message_text("❌ **Error:** Invalid selection data. Please try the process again.")
         return
@@ -282,52 +535,38 @@ async def handle_item_selection_callback(update: Update, context: ContextTypes.D
 
 async def generate_and_send_receipt(update: Update, context: ContextTypes.DEFAULT_TYPE, master_sheet_row_index: int, cuotas_a_pagar: int) -> None:
     """
-    Fetches credit data, generates a payment ticket image, logs the payment, 
+    Fetches credit data, logs the payment, generates a payment ticket image
     and sends the ticket to the user.
     """
     effective_chat_id = update.effective_chat.id
     user_id = update.effective_user.id if update.effective_user else "UnknownUser"
     
     remito_number_str = "N/A"
-    log_sheet_next_row = None
 
     try:
-        # 1. Determine Remito Number (based on next empty log row)
-        # (Note: This Remito Number is optional and based on the client's preferences, but I suggest using it as a decent way to have an intern code, 
-        # that both works as a ticket ID and a way to find easily the row & productID of that ticket on the sheet).
-        try:
-            log_sheet_next_row = find_first_empty_log_row()
-            logger.info(f"Next available log row for Remito generation: {log_sheet_next_row} (User: {user_id})")
-        except Exception as e_log_row:
-            logger.error(f"Error determining next log row for Remito (User: {user_id}): {e_log_row}", exc_info=True)
-            # Proceed without Remito if this fails, or handle as critical error 
-
-        # 2. Fetch full credit data from Master Sheet
+        # 1. Fetch full credit data from Master Sheet
         logger.info(f"Fetching credit details for master row {master_sheet_row_index} to generate receipt (User: {user_id}).")
-        credit = get_credit_data(master_sheet_row_index) 
-
-        # 3. Construct Remito Number if possible
-        if log_sheet_next_row and credit.get('id_articulo') and credit['id_articulo'] != "N/A":
-            try:
-                # Format: 000(ID_Articulo)/0000(LogRow)
-                remito_number_str = f"{int(credit['id_articulo']):03d}/{log_sheet_next_row:04d}"
-                logger.info(f"Generated Remito number: {remito_number_str} (User: {user_id})")
-            except (ValueError, TypeError) as e_remito_format:
-                logger.error(f"Error formatting Remito number (ID Art: {credit['id_articulo']}, Log Row: {log_sheet_next_row}): {e_remito_format}")
-                remito_number_str = "Error/Format"
-        
-        # 4. Validate payment feasibility
+        # Sheets calls block on network I/O, so they run in worker threads (as in process_payment_request).
+        # Read fresh, not from the search cache: Cuotas Abonadas is validated and incremented from this value,
+        # and another instance of the bot may have logged a payment on this credit since the search.
+        credit = await asyncio.to_thread(get_credit_data, master_sheet_row_index, use_cache=False)
+        # Unpack the fields used repeatedly below once
+        nombre, apellido = credit['nombre'], credit['apellido']
+        articulo, codigo, id_articulo = credit['articulo'], credit['codigo'], credit['id_articulo']
+        importe_cuota = credit['importe_cuota']
+
+        # 2. Validate payment feasibility
         total_cuotas_sheet = credit['total_cuotas']
         cuotas_abonadas_antes_sheet = credit['cuotas_abonadas_antes']
 
         if cuotas_abonadas_antes_sheet >= total_cuotas_sheet:
             msg = (
                 f"✅ **Credit Fully Paid!**\n"
-                f"Item: {credit['articulo']} (Code: {credit['codigo']})\n"
-                f"Client: {credit['nombre']} {credit['apellido']}\n"
+                f"Item: {articulo} (Code: {codigo})\n"
+                f"Client: {nombre} {apellido}\n"
                 f"All {total_cuotas_sheet} installments already paid."
             )
-            logger.warning(f"Attempt to pay for already completed credit. MasterRow: {master_sheet_row_index}, Art: {credit['articulo']}. (User:{user_id})")
+            logger.warning(f"Attempt to pay for already completed credit. MasterRow: {master_sheet_row_index}, Art: {articulo}. (User:{user_id})")
             # If query exists (from button click), edit. Else, send new.
             if update.callback_query:
                 await update.callback_query.edit_message_text(msg, parse_mode='Markdown')
@@ -339,8 +578,8 @@ async def generate_and_send_receipt(update: Update, context: ContextTypes.DEFAUL
         if cuotas_a_pagar > cuotas_restantes:
             msg = (
                 f"⚠️ **Payment Exceeds Remaining Installments!**\n"
-                f"Item: {credit['articulo']} (Code: {credit['codigo']})\n"
-                f"Client: {credit['nombre']} {credit['apellido']}\n"
+                f"Item: {articulo} (Code: {codigo})\n"
+                f"Client: {nombre} {apellido}\n"
                 f"Attempting to pay: **{cuotas_a_pagar}** installments.\n"
                 f"Remaining installments: **{cuotas_restantes}**.\n\n"
                 "Please restart the process (/start) with the correct number of installments."
@@ -352,63 +591,101 @@ async def generate_and_send_receipt(update: Update, context: ContextTypes.DEFAUL
                 await context.bot.send_message(chat_id=effective_chat_id, text=msg, parse_mode='Markdown')
             return
 
-        # 5. Prepare data for the ticket
-        cobrador_name = "John" # Username of the salesperson/user that handles the tickets
-        current_installment_start_num = cuotas_abonadas_antes_sheet + 1
-        current_installment_end_num = cuotas_abonadas_antes_sheet + cuotas_a_pagar
-        rango_cuotas_pagadas_str = f"{current_installment_start_num} to {current_installment_end_num} of {total_cuotas_sheet}"
-        if cuotas_a_pagar == 1:
-             rango_cuotas_pagadas_str = f"{current_installment_start_num} of {total_cuotas_sheet}"
-
-
-        saldo_pagado_total_actualizado = credit['importe_cuota'] * (cuotas_abonadas_antes_sheet + cuotas_a_pagar)
-        total_monto_pago_actual = credit['importe_cuota'] * cuotas_a_pagar
-        fecha_hora_ticket = datetime.now().strftime("%d/%m/%Y - %H:%M:%S")
-
-        # Using the client's format as a simple and complete example, suitable for modifications including 
-        # adding a business logo and/or other embedded graphic content.
-        ticket_text_content = (
-            f"**Comprobante de Pago**\n\n\n"
-            f"**Fecha:** {fecha_hora_ticket}\n\n"
-            f"**Cliente:** {credit['nombre']} {credit['apellido']}\n"
-            f"**Comercio:** {credit['local_comercial']}\n"
-            f"**Dirección:** {credit['direccion']}\n"
-            f"------------------------------------------\n\n"
-            f"**IMPORTE POR CUOTA: ${credit['importe_cuota']:,.2f}**\n" # Format currency
-            f"**CUOTAS PAGADAS HOY: {cuotas_a_pagar}**\n"
-            f"**ARTÍCULO: {credit['articulo']} (Código: {credit['codigo']})**\n"
-            f"**PAGO DE CUOTAS NRO: {rango_cuotas_pagadas_str}**\n"
-            f"**SALDO PAGADO TOTAL: ${saldo_pagado_total_actualizado:,.2f} de ${credit['total_credito']:,.2f}**\n"
-            f"**REMITO Nro: {remito_number_str}**\n"
-            f"------------------------------------------\n\n"
-            f"**TOTAL PAGADO HOY: ${total_monto_pago_actual:,.2f}**\n"
-            f"**COBRADOR: {cobrador_name}**\n\n"
-            f"Exija y conserve este comprobante de pago.\n"
-            f"**********************************\n\n"
-            f"**¡ATENCIÓN!**\n"
-            f"- Los pagos se realizan de Lunes a Sábado,\n  y feriados inclusive.\n"
-            f"**********************************"
-        )
-
-        # 6. Generate and send ticket image
-        ticket_image_bytes = generate_ticket_image(ticket_text_content)
-        await context.bot.send_photo(
-            chat_id=effective_chat_id, 
-            photo=ticket_image_bytes, 
-            caption=f"📄 Payment ticket for {credit['articulo']} (Code: {credit['codigo']})."
-        )
-        logger.info(f"Payment ticket sent for MasterRow {master_sheet_row_index}, {cuotas_a_pagar} installments. (User:{user_id})")
+        # 3. Log payment (this also updates Cuotas Abonadas in the master sheet).
+        # Logged before the ticket is built: the log row the entry was appended to gives the Remito Number.
+        master_update_warning = None
+        try:
+            log_sheet_row = await asyncio.to_thread(
+                log_payment_and_update_credit, credit_data=credit, cantidad_cuotas_pagadas=cuotas_a_pagar
+            )
+            logger.info(f"Payment logged successfully for MasterRow {master_sheet_row_index} at log row {log_sheet_row}. (User:{user_id})")
+        except MasterUpdateError as e:
+            # The log entry exists, so the receipt is still issued (from its log row); only the master record needs fixing
+            log_sheet_row = e.log_row
+            logger.critical(f"Payment logged at log row {e.log_row} but master record not updated (MasterRow {master_sheet_row_index}, User {user_id}): {e}")
+            master_update_warning = (
+                f"⚠️ The master record could not be updated: 'Cuotas Abonadas' in master row {e.master_row_index} should be {e.cuotas_abonadas}.\n"
+                "The payment WAS logged, do NOT register it again. Please ask an administrator to correct the master sheet."
+            )
 
-        # 7. Log payment (this also updates master sheet if that logic is enabled in sheet.py)
-        log_payment_and_update_credit(credit_data=credit, cantidad_cuotas_pagadas=cuotas_a_pagar)
-        logger.info(f"Payment logged successfully for MasterRow {master_sheet_row_index}. (User:{user_id})")
+        # From here on the payment is in the log: a failure must not read as "maybe not registered",
+        # or the collector may register it again and log it twice.
+        try:
+            # 4. Construct Remito Number if possible
+            # (Note: This Remito Number is optional and based on the client's preferences, but I suggest using it as a decent way to have an intern code, 
+            # that both works as a ticket ID and a way to find easily the row & productID of that ticket on the sheet).
+            if log_sheet_row and id_articulo and id_articulo != "N/A":
+                try:
+                    # Format: 000(ID_Articulo)/0000(LogRow)
+                    remito_number_str = f"{int(id_articulo):03d}/{log_sheet_row:04d}"
+                    logger.info(f"Generated Remito number: {remito_number_str} (User: {user_id})")
+                except (ValueError, TypeError) as e_remito_format:
+                    logger.error(f"Error formatting Remito number (ID Art: {id_articulo}, Log Row: {log_sheet_row}): {e_remito_format}")
+                    remito_number_str = "Error/Format"
+
+            # 5. Prepare data for the ticket
+            cobrador_name = "John" # Username of the salesperson/user that handles the tickets
+            current_installment_start_num = cuotas_abonadas_antes_sheet + 1
+            current_installment_end_num = cuotas_abonadas_antes_sheet + cuotas_a_pagar
+            rango_cuotas_pagadas_str = f"{current_installment_start_num} to {current_installment_end_num} of {total_cuotas_sheet}"
+            if cuotas_a_pagar == 1:
+                 rango_cuotas_pagadas_str = f"{current_installment_start_num} of {total_cuotas_sheet}"
+
+
+            saldo_pagado_total_actualizado = importe_cuota * (cuotas_abonadas_antes_sheet + cuotas_a_pagar)
+            total_monto_pago_actual = importe_cuota * cuotas_a_pagar
+            now = datetime.now()
+            # Same output as strftime("%d/%m/%Y - %H:%M:%S"), without going through strftime's format parser
+            fecha_hora_ticket = f"{now.day:02d}/{now.month:02d}/{now.year} - {now.hour:02d}:{now.minute:02d}:{now.second:02d}"
+
+            ticket_fields = {
+                "fecha": fecha_hora_ticket,
+                "nombre": nombre,
+                "apellido": apellido,
+                "local_comercial": credit['local_comercial'],
+                "direccion": credit['direccion'],
+                "importe_cuota": importe_cuota,
+                "cuotas_a_pagar": cuotas_a_pagar,
+                "articulo": articulo,
+                "codigo": codigo,
+                "rango_cuotas_pagadas": rango_cuotas_pagadas_str,
+                "saldo_pagado_total": saldo_pagado_total_actualizado,
+                "total_credito": credit['total_credito'],
+                "remito": remito_number_str,
+                "total_pagado_hoy": total_monto_pago_actual,
+                "cobrador": cobrador_name,
+            }
+
+            # 6. Generate and send ticket image
+            ticket_image_bytes = generate_ticket_image(ticket_fields)
+            await context.bot.send_photo(
+                chat_id=effective_chat_id, 
+                photo=ticket_image_bytes, 
+                caption=f"📄 Payment ticket for {articulo} (Code: {codigo})."
+            )
+            logger.info(f"Payment ticket sent for MasterRow {master_sheet_row_index}, {cuotas_a_pagar} installments. (User:{user_id})")
         
-        # Confirmation message (edit original if from callback, else send new)
-        success_message = f"✅ Payment of {cuotas_a_pagar} installment(s) for '{credit['articulo']}' registered successfully!"
-        if update.callback_query:
-            await update.callback_query.edit_message_text(success_message)
-        else:
-            await context.bot.send_message(chat_id=effective_chat_id, text=success_message)
+            # Confirmation message (edit original if from callback, else send new)
+            success_message = f"✅ Payment of {cuotas_a_pagar} installment(s) for '{articulo}' registered successfully!"
+            if master_update_warning:
+                success_message = f"{success_message}\n\n{master_update_warning}"
+            if update.callback_query:
+                await update.callback_query.edit_message_text(success_message)
+            else:
+                await context.bot.send_message(chat_id=effective_chat_id, text=success_message)
+        except Exception as e:
+            logger.critical(f"Payment logged at log row {log_sheet_row} but the ticket could not be generated/sent (MasterRow {master_sheet_row_index}, User {user_id}): {e}", exc_info=True)
+            error_text = (
+                f"❌ The payment WAS logged (log row {log_sheet_row}), but the ticket could not be generated or sent.\n"
+                "Do NOT register this payment again. Please contact an administrator for the receipt."
+            )
+            if master_update_warning:
+                error_text = f"{error_text}\n\n{master_update_warning}"
+            if update.callback_query:
+                try: await update.callback_query.edit_message_text(error_text)
+                except Exception: await context.bot.send_message(chat_id=effective_chat_id, text=error_text)
+            else:
+                await context.bot.send_message(chat_id=effective_chat_id, text=error_text)
 
 
     except ConnectionError as e:
@@ -1,13 +1,61 @@
 import gspread
+from gspread.utils import a1_to_rowcol, absolute_range_name
 from datetime import datetime
+import functools
 import logging
+from operator import itemgetter
+import random
+import re
+import time
+from requests.adapters import HTTPAdapter
 from config import SHEET_ID, get_google_credentials 
 
 # ---- Logger setup ----
 logger = logging.getLogger(__name__)
 
+# ---- Exceptions ----
+class MasterUpdateError(RuntimeError):
+    """
+    Raised by log_payment_and_update_credit when the payment was appended to the log table but
+    'Cuotas Abonadas' of the master record could not be updated afterwards. The payment must not be
+    logged again; the attributes say which cell an admin has to fix.
+    """
+    def __init__(self, message: str, log_row: int, master_row_index: int, cuotas_abonadas: int):
+        super().__init__(message)
+        self.log_row = log_row
+        self.master_row_index = master_row_index
+        self.cuotas_abonadas = cuotas_abonadas
+
+
 # ---- Global variable for the sheet connection ----
 google_sheet_instance = None
+# Authorized gspread client (credentials + HTTP session), kept across reconnects: only the
+# spreadsheet/worksheet handles are reopened, so the access token and pooled connections survive
+_gspread_client = None
+# time.monotonic() of the last successful connection; the cached one is reused for CONNECTION_MAX_AGE_SECONDS
+_sheet_connected_at = 0.0
+CONNECTION_MAX_AGE_SECONDS = 600
+# Kept-alive HTTPS connections to the Sheets API: enough for the handlers' worker threads to make
+# concurrent requests without opening (and TLS-handshaking) a new connection for each one
+HTTP_POOL_MAXSIZE = 16
+
+# ---- Master data cache ----
+# (fetched_at, rows, name_index) for the master table block (M2:X, up to MASTER_LAST_ROW), used by find_client_credits
+# and by get_credit_data unless called with use_cache=False. Its values may be up to MASTER_CACHE_TTL_SECONDS old
+# (other bot instances can log payments meanwhile), so the payment path reads its row fresh.
+# Cleared whenever this process logs a payment.
+MASTER_CACHE_TTL_SECONDS = 60
+# Last sheet row the master table may occupy. The read range is fixed: values.get already omits
+# trailing empty rows, and the worksheet's row_count would go stale while the connection is reused.
+MASTER_LAST_ROW = 500
+_master_block_cache = None
+
+# ---- Quota backoff ----
+# Sheets answers bursts over the per-minute quota with 429 and occasionally fails with 5xx;
+# both are transient, so those requests are retried with truncated exponential backoff (1s, 2s, 4s, 8s...) plus jitter.
+RETRY_MAX_ATTEMPTS = 5
+RETRY_MAX_DELAY_SECONDS = 60
+RETRYABLE_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
 
 # ---- Column Constants (adjust if your sheet structure differs) ----
 # Master Credit Data Table 
@@ -37,21 +85,33 @@ COL_LOG_IMPORTE_CUOTA = 'H'
 COL_LOG_CANT_CUOTAS_PAGADAS = 'I' 
 
 
+def _get_gspread_client(credentials):
+    """Returns the module's authorized gspread client, creating it on first use."""
+    global _gspread_client
+    if _gspread_client is None:
+        gc = gspread.authorize(credentials)
+        # gspread 6 keeps the requests session on gc.http_client, gspread 5 on the client itself.
+        # No adapter-level retries: retry_on_quota decides what is safe to repeat
+        http_session = getattr(gc, "http_client", gc).session
+        http_session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_MAXSIZE))
+        _gspread_client = gc
+    return _gspread_client
+
+
 def connect_to_sheet():
     """
     Establishes and returns a connection to the Google Sheet.
-    Uses a global variable to cache the connection.
+    Uses a global variable to cache the connection, reused without any request until it is
+    CONNECTION_MAX_AGE_SECONDS old or a Sheets call fails (see reset_sheet_connection),
+    then reopened with the same authorized client.
     """
-    global google_sheet_instance
+    global google_sheet_instance, _sheet_connected_at
     if google_sheet_instance:
-        try:
-            # Simple check to see if connection is alive
-            google_sheet_instance.title
+        if time.monotonic() - _sheet_connected_at < CONNECTION_MAX_AGE_SECONDS:
             logger.debug("Reusing existing Google Sheets connection.")
             return google_sheet_instance
-        except Exception as e:
-            logger.warning(f"Existing Google Sheets connection seems stale ({e}), re-establishing.")
-            google_sheet_instance = None # Force re-connection
+        logger.info("Google Sheets connection is older than the max age, re-establishing.")
+        google_sheet_instance = None # Force re-connection
 
     credentials = get_google_credentials()
     if not credentials:
@@ -62,8 +122,9 @@ def connect_to_sheet():
         return None
 
     try:
-        gc = gspread.authorize(credentials)
+        gc = _get_gspread_client(credentials)
         google_sheet_instance = gc.open_by_key(SHEET_ID).sheet1 # Assuming data is on the first sheet
+        _sheet_connected_at = time.monotonic()
         logger.info(f"Successfully connected to Google Sheet: '{google_sheet_instance.title}' (ID: {SHEET_ID})")
         return google_sheet_instance
     except gspread.exceptions.APIError as e:
@@ -74,6 +135,39 @@ def connect_to_sheet():
     google_sheet_instance = None # Ensure it's None if connection failed
     return None
 
+
+def reset_sheet_connection() -> None:
+    """Drops the cached worksheet so the next connect_to_sheet call reopens the sheet (the client is kept)."""
+    global google_sheet_instance
+    google_sheet_instance = None
+
+
+def retry_on_quota(retry_statuses: frozenset = RETRYABLE_STATUS_CODES):
+    """
+    Decorator: retries the wrapped Sheets call when it fails with a gspread APIError whose
+    HTTP status is in `retry_statuses`, waiting 2**attempt seconds (capped) plus up to 1s of jitter.
+    Other errors, and the last failed attempt, are raised unchanged.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            for attempt in range(1, RETRY_MAX_ATTEMPTS + 1):
+                try:
+                    return func(*args, **kwargs)
+                except gspread.exceptions.APIError as e:
+                    status_code = getattr(getattr(e, "response", None), "status_code", None)
+                    if status_code not in retry_statuses or attempt == RETRY_MAX_ATTEMPTS:
+                        raise
+                    delay = min(RETRY_MAX_DELAY_SECONDS, 2 ** (attempt - 1)) + random.uniform(0, 1)
+                    logger.warning(
+                        f"{func.__name__}: Sheets API returned {status_code} (attempt {attempt}/{RETRY_MAX_ATTEMPTS}), "
+                        f"retrying in {delay:.1f}s."
+                    )
+                    time.sleep(delay)
+        return wrapper
+    return decorator
+
+
 def col_to_index(col_letter: str) -> int:
     """Converts a column letter (e.g., 'A', 'Z', 'AA') to a 0-based index."""
     index = 0
@@ -84,6 +178,104 @@ def col_to_index(col_letter: str) -> int:
     return index - 1
 
 
+# ---- Column positions (computed once at import) ----
+# 0-based positions within a master table row as read from the sheet, which starts at COL_MASTER_NOMBRE
+_MASTER_BASE_COL_INDEX = col_to_index(COL_MASTER_NOMBRE)
+IDX_MASTER_NOMBRE = col_to_index(COL_MASTER_NOMBRE) - _MASTER_BASE_COL_INDEX
+IDX_MASTER_APELLIDO = col_to_index(COL_MASTER_APELLIDO) - _MASTER_BASE_COL_INDEX
+IDX_MASTER_ARTICULO = col_to_index(COL_MASTER_ARTICULO) - _MASTER_BASE_COL_INDEX
+IDX_MASTER_CODIGO = col_to_index(COL_MASTER_CODIGO) - _MASTER_BASE_COL_INDEX
+IDX_MASTER_ID_ARTICULO = col_to_index(COL_MASTER_ID_ARTICULO) - _MASTER_BASE_COL_INDEX
+IDX_MASTER_COMERCIO = col_to_index(COL_MASTER_COMERCIO) - _MASTER_BASE_COL_INDEX
+IDX_MASTER_DIRECCION = col_to_index(COL_MASTER_DIRECCION) - _MASTER_BASE_COL_INDEX
+IDX_MASTER_TOTAL_CREDITO = col_to_index(COL_MASTER_TOTAL_CREDITO) - _MASTER_BASE_COL_INDEX
+IDX_MASTER_IMPORTE_CUOTA = col_to_index(COL_MASTER_IMPORTE_CUOTA) - _MASTER_BASE_COL_INDEX
+IDX_MASTER_TOTAL_CUOTAS = col_to_index(COL_MASTER_TOTAL_CUOTAS) - _MASTER_BASE_COL_INDEX
+IDX_MASTER_CUOTAS_ABONADAS = col_to_index(COL_MASTER_CUOTAS_ABONADAS) - _MASTER_BASE_COL_INDEX
+# Highest position find_client_credits reads (nombre, apellido, articulo, codigo, id_articulo)
+_MAX_SEARCH_IDX = max(IDX_MASTER_NOMBRE, IDX_MASTER_APELLIDO, IDX_MASTER_ARTICULO, IDX_MASTER_CODIGO, IDX_MASTER_ID_ARTICULO)
+# Credit dict fields parsed from a master row: (key, position, type, default when empty/unparsable)
+MASTER_SCHEMA = (
+    ("nombre", IDX_MASTER_NOMBRE, str, "N/A"),
+    ("apellido", IDX_MASTER_APELLIDO, str, "N/A"),
+    ("articulo", IDX_MASTER_ARTICULO, str, "N/A"),
+    ("codigo", IDX_MASTER_CODIGO, str, "N/A"),
+    ("id_articulo", IDX_MASTER_ID_ARTICULO, str, "N/A"),
+    ("local_comercial", IDX_MASTER_COMERCIO, str, "N/A"),
+    ("direccion", IDX_MASTER_DIRECCION, str, "N/A"),
+    ("total_credito", IDX_MASTER_TOTAL_CREDITO, float, 0.0),
+    ("importe_cuota", IDX_MASTER_IMPORTE_CUOTA, float, 0.0),
+    ("total_cuotas", IDX_MASTER_TOTAL_CUOTAS, int, 0),
+    ("cuotas_abonadas_antes", IDX_MASTER_CUOTAS_ABONADAS, int, 0),
+)
+# Currency symbol and thousand separators users may type into numeric cells
+CURRENCY_RE = re.compile(r'[\$\.]')
+
+
+def _values_get(sheet, range_a1: str) -> list:
+    """
+    Reads `range_a1` of the worksheet with a 'values' fields mask, so the response carries
+    no range/dimension metadata. Rows come back as the API sends them: trailing empty cells omitted.
+    """
+    response = sheet.spreadsheet.values_get(absolute_range_name(sheet.title, range_a1), params={"fields": "values"})
+    return response.get("values", [])
+
+
+def _name_key(nombre: str, apellido: str) -> tuple:
+    """Case-insensitive lookup key for a client name. casefold (not lower) so that e.g. 'ß' matches 'ss'."""
+    return nombre.strip().casefold(), apellido.strip().casefold()
+
+
+def _build_master_name_index(rows: list) -> dict:
+    """
+    Maps each (nombre, apellido) pair of the master table, as a _name_key, to the positions
+    of its rows within `rows`. Built once per fetch, so a client search is a dict lookup
+    instead of comparing the names of every row.
+    """
+    name_index = {}
+    for i, row_values in enumerate(rows):
+        if len(row_values) > IDX_MASTER_APELLIDO:
+            name_key = _name_key(row_values[IDX_MASTER_NOMBRE], row_values[IDX_MASTER_APELLIDO])
+            name_index.setdefault(name_key, []).append(i)
+    return name_index
+
+
+@retry_on_quota()
+def _get_master_block(sheet) -> tuple:
+    """
+    Returns the rows of the master data table (cols M:X, starting at row 2) and their
+    name index (see _build_master_name_index), served from the cache while it is fresh
+    and fetched in a single read otherwise.
+    """
+    global _master_block_cache
+    if _master_block_cache and time.monotonic() - _master_block_cache[0] < MASTER_CACHE_TTL_SECONDS:
+        logger.debug("Using cached master table block.")
+        return _master_block_cache[1], _master_block_cache[2]
+
+    range_to_read = f'{COL_MASTER_NOMBRE}2:{COL_MASTER_CUOTAS_ABONADAS}{MASTER_LAST_ROW}'
+    logger.info(f"Fetching master table block {range_to_read}.")
+    rows = _values_get(sheet, range_to_read)
+    name_index = _build_master_name_index(rows)
+    _master_block_cache = (time.monotonic(), rows, name_index)
+    return rows, name_index
+
+
+def _get_cached_master_row(row_index: int):
+    """Returns the cached master row (cols M:X) for a 1-based sheet row, or None if it isn't cached or is stale."""
+    if not _master_block_cache or time.monotonic() - _master_block_cache[0] >= MASTER_CACHE_TTL_SECONDS:
+        return None
+    rows = _master_block_cache[1]
+    if 0 <= row_index - 2 < len(rows):
+        return rows[row_index - 2]
+    return None
+
+
+def invalidate_master_cache() -> None:
+    """Drops the cached master table block, forcing the next read to hit the sheet."""
+    global _master_block_cache
+    _master_block_cache = None
+
+
 def find_client_credits(nombre_buscar: str, apellido_buscar: str) -> list:
     """
     Searches for active client credits in the master data table.
@@ -96,196 +288,248 @@ def find_client_credits(nombre_buscar: str, apellido_buscar: str) -> list:
         raise ConnectionError("Google Sheet connection not available.")
 
     try:
-        # Define the range to read based on columns used for matching and display
-        range_to_read = f'{COL_MASTER_NOMBRE}2:{COL_MASTER_ID_ARTICULO}500'
-        logger.info(f"Searching for client: '{nombre_buscar} {apellido_buscar}' in range {range_to_read}")
+        logger.info(f"Searching for client: '{nombre_buscar} {apellido_buscar}' in the master table.")
         
-        all_data = sheet.get_values(range_to_read)
+        all_data, name_index = _get_master_block(sheet)
         matches = []
 
-        # Relative column indices within the fetched `all_data`
-        # Assuming COL_MASTER_NOMBRE is the first column in `range_to_read`
-        base_col_index = col_to_index(COL_MASTER_NOMBRE)
-        idx_nombre_rel = col_to_index(COL_MASTER_NOMBRE) - base_col_index
-        idx_apellido_rel = col_to_index(COL_MASTER_APELLIDO) - base_col_index
-        idx_articulo_rel = col_to_index(COL_MASTER_ARTICULO) - base_col_index
-        idx_codigo_rel = col_to_index(COL_MASTER_CODIGO) - base_col_index
-        idx_id_articulo_rel = col_to_index(COL_MASTER_ID_ARTICULO) - base_col_index
-
-        for i, row_values in enumerate(all_data):
+        # Only the rows whose name matches, straight from the name index
+        for i in name_index.get(_name_key(nombre_buscar, apellido_buscar), []):
+            row_values = all_data[i]
             # Ensure row has enough columns for all required fields
-            if len(row_values) <= max(idx_nombre_rel, idx_apellido_rel, idx_articulo_rel, idx_codigo_rel, idx_id_articulo_rel):
+            if len(row_values) <= _MAX_SEARCH_IDX:
                 # logger.debug(f"Skipping row {i+2}: not enough columns (has {len(row_values)}).")
                 continue
 
-            nombre_sheet = row_values[idx_nombre_rel].strip()
-            apellido_sheet = row_values[idx_apellido_rel].strip()
-
-            if nombre_sheet.lower() == nombre_buscar.lower() and apellido_sheet.lower() == apellido_buscar.lower():
-                articulo = row_values[idx_articulo_rel].strip() if idx_articulo_rel < len(row_values) else "N/A"
-                codigo = row_values[idx_codigo_rel].strip() if idx_codigo_rel < len(row_values) else "N/A"
-                id_articulo = row_values[idx_id_articulo_rel].strip() if idx_id_articulo_rel < len(row_values) else "N/A"
-                
-                # Critical: Only consider entries with a valid ID Articulo and Codigo
-                if not id_articulo or id_articulo == "N/A" or id_articulo == "":
-                    logger.warning(f"Client '{nombre_sheet} {apellido_sheet}' in master sheet row {i+2} skipped: missing ID Articulo.")
-                    continue
-                if not codigo or codigo == "N/A" or codigo == "":
-                    logger.warning(f"Client '{nombre_sheet} {apellido_sheet}' in master sheet row {i+2} skipped: missing Codigo Articulo.")
-                    continue
-
-                matches.append({
-                    "row_index": i + 2, 
-                    "articulo": articulo,
-                    "id_articulo": id_articulo,
-                    "codigo": codigo
-                })
+            nombre_sheet = row_values[IDX_MASTER_NOMBRE].strip()
+            apellido_sheet = row_values[IDX_MASTER_APELLIDO].strip()
+
+            articulo = row_values[IDX_MASTER_ARTICULO].strip() if IDX_MASTER_ARTICULO < len(row_values) else "N/A"
+            codigo = row_values[IDX_MASTER_CODIGO].strip() if IDX_MASTER_CODIGO < len(row_values) else "N/A"
+            id_articulo = row_values[IDX_MASTER_ID_ARTICULO].strip() if IDX_MASTER_ID_ARTICULO < len(row_values) else "N/A"
+            
+            # Critical: Only consider entries with a valid ID Articulo and Codigo
+            if not id_articulo or id_articulo == "N/A" or id_articulo == "":
+                logger.warning(f"Client '{nombre_sheet} {apellido_sheet}' in master sheet row {i+2} skipped: missing ID Articulo.")
+                continue
+            if not codigo or codigo == "N/A" or codigo == "":
+                logger.warning(f"Client '{nombre_sheet} {apellido_sheet}' in master sheet row {i+2} skipped: missing Codigo Articulo.")
+                continue
+
+            matches.append({
+                "row_index": i + 2, 
+                "articulo": articulo,
+                "id_articulo": id_articulo,
+                "codigo": codigo
+            })
         
         logger.info(f"Found {len(matches)} potential credit(s) for '{nombre_buscar} {apellido_buscar}'.")
         return matches
 
     except gspread.exceptions.APIError as e:
         logger.error(f"Google Sheets API Error while finding client credits: {e}", exc_info=True)
+        reset_sheet_connection()
         raise ConnectionError(f"API Error during client search: {e}")
     except Exception as e:
         logger.error(f"Unexpected error finding client credits: {e}", exc_info=True)
         raise # Re-raise to be caught by a higher level handler
 
 
-def get_credit_data(row_index: int) -> dict:
+@retry_on_quota()
+def _fetch_master_rows(sheet, row_indices: list) -> dict:
+    """
+    Reads the master table columns (M:X) of several sheet rows in a single batchGet request.
+    Returns {row_index: row values}, with an empty list for blank rows.
+    """
+    ranges = [
+        absolute_range_name(sheet.title, f'{COL_MASTER_NOMBRE}{row_index}:{COL_MASTER_CUOTAS_ABONADAS}{row_index}')
+        for row_index in row_indices
+    ]
+    response = sheet.spreadsheet.values_batch_get(ranges, params={"fields": "valueRanges.values"})
+    # One valueRange per requested range, in request order ({} when the range is empty)
+    value_ranges = response.get("valueRanges", [])
+    return {
+        row_index: (value_range.get("values") or [[]])[0]
+        for row_index, value_range in zip(row_indices, value_ranges)
+    }
+
+
+def _parse_cell(raw: str, data_type, default_val):
+    """Converts a master cell to `data_type`; empty or unparsable values give `default_val`."""
+    val_str = raw.strip()
+    if not val_str: # Empty string
+        return default_val
+    if data_type is str:
+        return val_str
+    # Assumes , as decimal for conversion (configure if using another conversion unit)
+    cleaned_val = CURRENCY_RE.sub('', val_str)
+    if data_type is int:
+        return int(cleaned_val.split(',')[0])
+    return data_type(cleaned_val.replace(',', '.'))
+
+
+def _parse_credit_row(row_values: list, row_index: int) -> dict:
+    """
+    Builds the credit dict from the master table columns (M:X) of sheet row `row_index`,
+    following MASTER_SCHEMA. Missing or unparsable cells get their default; no validation.
+    """
+    row_length = len(row_values)
+    credit = {"row_index": row_index} # Keep track of the original row
+    for key, cell_idx, data_type, default_val in MASTER_SCHEMA:
+        if cell_idx >= row_length:
+            logger.warning(f"Field '{key}' (index {cell_idx}) out of bounds for row {row_index} (length {row_length}). Returning default.")
+            credit[key] = default_val
+            continue
+        try:
+            credit[key] = _parse_cell(str(row_values[cell_idx]), data_type, default_val)
+        except (ValueError, TypeError) as e:
+            logger.error(f"Error converting value '{row_values[cell_idx]}' of '{key}' (row {row_index}) to {data_type}: {e}. Returning default.")
+            credit[key] = default_val
+    return credit
+
+
+def _validate_credit(credit: dict) -> None:
+    """Critical data validation of a parsed credit; raises ValueError if it can't be used for a payment."""
+    row_index = credit["row_index"]
+    if not credit["id_articulo"] or credit["id_articulo"] == "N/A":
+        msg = f"ID Articulo is missing or invalid for credit at master row {row_index}."
+        logger.error(msg)
+        raise ValueError(msg)
+    if not credit["codigo"] or credit["codigo"] == "N/A":
+        msg = f"Codigo Articulo is missing or invalid for credit at master row {row_index}."
+        logger.error(msg)
+        raise ValueError(msg)
+    if credit["importe_cuota"] <= 0:
+        msg = f"Importe Cuota is invalid (must be > 0) for credit at master row {row_index}."
+        logger.error(msg)
+        raise ValueError(msg)
+    if credit["total_cuotas"] <= 0:
+        msg = f"Total Cuotas is invalid (must be > 0) for credit at master row {row_index}."
+        logger.error(msg)
+        raise ValueError(msg)
+
+
+def get_credit_data(row_index: int, use_cache: bool = True) -> dict:
     """
     Retrieves full credit data for a specific row from the master data table.
+    Pass use_cache=False when the values must be current (e.g. before logging a payment).
+    """
+    return get_credit_data_many([row_index], use_cache=use_cache)[0]
+
+
+def get_credit_data_many(row_indices: list, use_cache: bool = True) -> list:
+    """
+    Retrieves full credit data for several rows of the master data table, in the order given.
+    Rows not in the master cache (all of them when use_cache=False) are read together in one request.
+    Raises ValueError if any of the rows is missing or invalid.
     """
     sheet = connect_to_sheet()
     if not sheet:
-        logger.error("get_credit_data: Sheet connection not available.")
+        logger.error("get_credit_data_many: Sheet connection not available.")
         raise ConnectionError("Google Sheet connection not available.")
 
     try:
-        # Define the full range for a single row of credit data
-        range_to_read = f'{COL_MASTER_NOMBRE}{row_index}:{COL_MASTER_CUOTAS_ABONADAS}{row_index}' 
-        logger.info(f"Fetching credit data for master sheet row {row_index}, range {range_to_read}")
+        logger.info(f"Fetching credit data for master sheet row(s) {row_indices}.")
         
-        row_values = sheet.row_values(row_index)
-        if not row_values:
-            logger.error(f"No data found for master sheet row {row_index}.")
-            raise ValueError(f"No data found in master sheet at row {row_index}")
-        
-        # logger.debug(f"Raw values for row {row_index}: {row_values}")
-
-        def _get_cell_value(col_letter: str, default_val=None, data_type=str):
-            """Helper to get value from `row_values` by column letter, with type conversion and error handling."""
-            try:
-                cell_idx = col_to_index(col_letter)
-                if cell_idx < len(row_values):
-                    val_str = str(row_values[cell_idx]).strip()
-                    if not val_str: # Empty string
-                        return default_val
-                    
-                    if data_type == int:
-                        # Handle potential currency symbols or thousand separators if users input them
-                        cleaned_val = val_str.replace('$', '').replace('.', '').split(',')[0] # Assumes , as decimal for conversion (configure if using another conversion unit)
-                        return int(cleaned_val)
-                    if data_type == float:
-                        cleaned_val = val_str.replace('$', '').replace('.', '').replace(',', '.')
-                        return float(cleaned_val)
-                    return data_type(val_str)
-                else:
-                    logger.warning(f"Column {col_letter} (index {cell_idx}) out of bounds for row {row_index} (length {len(row_values)}). Returning default.")
-                    return default_val
-            except (ValueError, TypeError) as e:
-                logger.error(f"Error converting value '{row_values[cell_idx]}' from col {col_letter} (row {row_index}) to {data_type}: {e}. Returning default.")
-                return default_val
-
-        credit = {
-            "row_index": row_index, # Keep track of the original row
-            "nombre": _get_cell_value(COL_MASTER_NOMBRE, "N/A", str),
-            "apellido": _get_cell_value(COL_MASTER_APELLIDO, "N/A", str),
-            "articulo": _get_cell_value(COL_MASTER_ARTICULO, "N/A", str),
-            "codigo": _get_cell_value(COL_MASTER_CODIGO, "N/A", str),
-            "id_articulo": _get_cell_value(COL_MASTER_ID_ARTICULO, "N/A", str),
-            "local_comercial": _get_cell_value(COL_MASTER_COMERCIO, "N/A", str),
-            "direccion": _get_cell_value(COL_MASTER_DIRECCION, "N/A", str),
-            "total_credito": _get_cell_value(COL_MASTER_TOTAL_CREDITO, 0.0, float),
-            "importe_cuota": _get_cell_value(COL_MASTER_IMPORTE_CUOTA, 0.0, float),
-            "total_cuotas": _get_cell_value(COL_MASTER_TOTAL_CUOTAS, 0, int),
-            "cuotas_abonadas_antes": _get_cell_value(COL_MASTER_CUOTAS_ABONADAS, 0, int),
-        }
-        
-        # Critical data validation
-        if not credit["id_articulo"] or credit["id_articulo"] == "N/A":
-            msg = f"ID Articulo is missing or invalid for credit at master row {row_index}."
-            logger.error(msg)
-            raise ValueError(msg)
-        if not credit["codigo"] or credit["codigo"] == "N/A":
-            msg = f"Codigo Articulo is missing or invalid for credit at master row {row_index}."
-            logger.error(msg)
-            raise ValueError(msg)
-        if credit["importe_cuota"] <= 0:
-            msg = f"Importe Cuota is invalid (must be > 0) for credit at master row {row_index}."
-            logger.error(msg)
-            raise ValueError(msg)
-        if credit["total_cuotas"] <= 0:
-            msg = f"Total Cuotas is invalid (must be > 0) for credit at master row {row_index}."
-            logger.error(msg)
-            raise ValueError(msg)
-
-        logger.info(f"Successfully fetched and parsed credit data for master row {row_index}.")
-        # logger.debug(f"Parsed credit data: {credit}")
-        return credit
+        # Master table columns (M:X) of each row: from the cache filled by find_client_credits when possible
+        rows_by_index = {}
+        for row_index in (row_indices if use_cache else ()):
+            row_values = _get_cached_master_row(row_index)
+            if row_values is not None:
+                logger.debug(f"Using cached master data for row {row_index}.")
+                rows_by_index[row_index] = row_values
+        rows_to_fetch = [row_index for row_index in dict.fromkeys(row_indices) if row_index not in rows_by_index]
+        if rows_to_fetch:
+            rows_by_index.update(_fetch_master_rows(sheet, rows_to_fetch))
+
+        credits = []
+        for row_index in row_indices:
+            row_values = rows_by_index.get(row_index)
+            if not row_values:
+                logger.error(f"No data found for master sheet row {row_index}.")
+                raise ValueError(f"No data found in master sheet at row {row_index}")
+
+            # logger.debug(f"Raw values for row {row_index}: {row_values}")
+            credit = _parse_credit_row(row_values, row_index)
+            _validate_credit(credit)
+            credits.append(credit)
+
+        logger.info(f"Successfully fetched and parsed credit data for master row(s) {row_indices}.")
+        # logger.debug(f"Parsed credit data: {credits}")
+        return credits
 
     except gspread.exceptions.APIError as e:
-        logger.error(f"Google Sheets API Error getting credit data for row {row_index}: {e}", exc_info=True)
+        logger.error(f"Google Sheets API Error getting credit data for row(s) {row_indices}: {e}", exc_info=True)
+        reset_sheet_connection()
         raise ConnectionError(f"API Error getting credit data: {e}")
     except ValueError as e: # Catch specific ValueErrors from parsing or validation
-        logger.error(f"Data validation error for credit data at row {row_index}: {e}", exc_info=True)
+        logger.error(f"Data validation error for credit data at row(s) {row_indices}: {e}", exc_info=True)
         raise
     except Exception as e:
-        logger.error(f"Unexpected error getting credit data for row {row_index}: {e}", exc_info=True)
+        logger.error(f"Unexpected error getting credit data for row(s) {row_indices}: {e}", exc_info=True)
         raise
 
 
-def find_first_empty_log_row() -> int:
-    """
-    Finds the first row in the payment log table (cols A:D) that is considered empty.
-    This is primarily used for generating the 'Remito' number.
-    Returns the 1-based row index.
-    """
-    sheet = connect_to_sheet()
-    if not sheet:
-        logger.error("find_first_empty_log_row: Sheet connection not available.")
-        raise ConnectionError("Google Sheet connection not available.")
-
-    try:
-        range_to_check = f'{COL_LOG_FECHA}2:{COL_LOG_ARTICULO}1000'
-        logger.info(f"Scanning for first empty log row in range {range_to_check}.")
-        log_table_preview = sheet.get_values(range_to_check)
-
-        for i, row_content in enumerate(log_table_preview):
-            # A row is empty if all relevant cells (A-D for this check) are empty strings
-            if all(not str(cell).strip() for cell in row_content):
-                empty_row_index = i + 2  
-                logger.info(f"Found first empty log row at index: {empty_row_index}.")
-                return empty_row_index
-        
-        # If loop finishes, all scanned rows have some data; append after the last scanned row.
-        next_row_index = len(log_table_preview) + 2
-        logger.info(f"No completely empty row found in scanned range. Next available log row: {next_row_index}.")
-        return next_row_index
-
-    except gspread.exceptions.APIError as e:
-        logger.error(f"Google Sheets API Error while finding empty log row: {e}", exc_info=True)
-        raise ConnectionError(f"API Error finding empty log row: {e}")
-    except Exception as e:
-        logger.error(f"Unexpected error finding empty log row: {e}", exc_info=True)
-        raise
+# credit_data fields copied as text into log columns B:G, in column order
+_LOG_TEXT_FIELDS = ("nombre", "apellido", "articulo", "id_articulo", "local_comercial", "direccion")
+_get_log_text_fields = itemgetter(*_LOG_TEXT_FIELDS)
+_LOG_REQUIRED_FIELDS = frozenset(_LOG_TEXT_FIELDS + ("importe_cuota",))
 
 
-def log_payment_and_update_credit(credit_data: dict, cantidad_cuotas_pagadas: int) -> None:
+def _build_log_row(credit_data: dict, cantidad_cuotas_pagadas: int, now: datetime) -> list:
+    """
+    Builds the payment log row (cols A:I) as strings for gspread.
+    `credit_data` must contain every key in _LOG_REQUIRED_FIELDS.
+    """
+    importe_str = format(credit_data["importe_cuota"], ".2f").replace('.', ',') # Format as currency string
+    return [
+        now.strftime("%d/%m/%Y"),
+        *map(str, _get_log_text_fields(credit_data)),
+        importe_str,
+        str(cantidad_cuotas_pagadas),
+    ]
+
+
+# Only retried on 429 (request rejected before it was applied): after a 5xx the row may already
+# have been appended, and appending it again would log the payment twice.
+@retry_on_quota(retry_statuses=frozenset({429}))
+def _append_log_row(sheet, log_entry_data: list, log_table_range: str) -> dict:
+    """
+    Appends one entry after the last row of the payment log table; returns the append API response,
+    masked down to 'updates.updatedRange'.
+    """
+    # OVERWRITE (not INSERT_ROWS) so that no rows are inserted into the sheet, which would shift the master table sharing it.
+    return sheet.spreadsheet.values_append(
+        absolute_range_name(sheet.title, log_table_range),
+        params={
+            "valueInputOption": "USER_ENTERED",
+            "insertDataOption": "OVERWRITE",
+            "fields": "updates.updatedRange",
+        },
+        body={"values": [log_entry_data]},
+    )
+
+
+@retry_on_quota()
+def _update_cuotas_abonadas(sheet, master_row_index: int, cuotas_abonadas: int) -> None:
+    """Sets 'Cuotas Abonadas' (col X) of a master record. Writes an absolute value, so it is safe to repeat."""
+    master_range_to_update = f"{COL_MASTER_CUOTAS_ABONADAS}{master_row_index}"
+    logger.info(f"Setting {master_range_to_update} to {cuotas_abonadas}.")
+    sheet.spreadsheet.values_update(
+        absolute_range_name(sheet.title, master_range_to_update),
+        params={"valueInputOption": "USER_ENTERED", "fields": "updatedRange"},
+        body={"values": [[cuotas_abonadas]]},
+    )
+
+
+def log_payment_and_update_credit(credit_data: dict, cantidad_cuotas_pagadas: int) -> int:
     """
-    Logs the payment details to the payment log table (Sheet1, cols A:I).
-    IMPORTANT: This function, as originally designed, does NOT update the master credit record (cols M:X).
-               It only logs the transaction. Updating the master record would be a separate step.
+    Logs the payment details to the payment log table (Sheet1, cols A:I) and increments
+    'Cuotas Abonadas' (col X) of the credit's master record (credit_data['row_index']).
+    The log entry is written with the Sheets append API, which finds the next row of the
+    log table server-side, so the log table never has to be read first.
+    Returns the 1-based log row the entry was written to (used for the 'Remito' number).
+    The two writes are separate requests: if the second one fails, MasterUpdateError is raised.
     """
     sheet = connect_to_sheet()
     if not sheet:
@@ -298,36 +542,58 @@ def log_payment_and_update_credit(credit_data: dict, cantidad_cuotas_pagadas: in
     if not isinstance(cantidad_cuotas_pagadas, int) or cantidad_cuotas_pagadas <= 0:
         logger.error(f"log_payment_and_update_credit: Invalid 'cantidad_cuotas_pagadas': {cantidad_cuotas_pagadas}.")
         raise ValueError("Invalid cantidad_cuotas_pagadas provided.")
+    master_row_index = credit_data.get("row_index")
+    if not isinstance(master_row_index, int) or master_row_index <= 1:
+        logger.error(f"log_payment_and_update_credit: Invalid master 'row_index': {master_row_index}.")
+        raise ValueError("Invalid row_index in credit_data provided for logging.")
+    missing_fields = _LOG_REQUIRED_FIELDS.difference(credit_data)
+    if missing_fields:
+        logger.error(f"log_payment_and_update_credit: 'credit_data' is missing {sorted(missing_fields)}.")
+        raise ValueError("Incomplete credit_data provided for logging.")
 
     try:
-        log_row_to_write = find_first_empty_log_row() # For Remito and where to write log
-        
-        current_datetime = datetime.now()
-        fecha_log = current_datetime.strftime("%d/%m/%Y") 
-
-        # Prepare data for logging, ensuring all values are strings for gspread
-        log_entry_data = [
-            fecha_log,
-            str(credit_data.get("nombre", "N/A")),
-            str(credit_data.get("apellido", "N/A")),
-            str(credit_data.get("articulo", "N/A")),
-            str(credit_data.get("id_articulo", "N/A")),
-            str(credit_data.get("local_comercial", "N/A")),
-            str(credit_data.get("direccion", "N/A")),
-            f"{credit_data.get('importe_cuota', 0.0):.2f}".replace('.', ','), # Format as currency string
-            str(cantidad_cuotas_pagadas)
-        ]
-
-        # Define the range for writing the log entry (e.g., A<row>:I<row>)
-        log_range_to_update = f"{COL_LOG_FECHA}{log_row_to_write}:{COL_LOG_CANT_CUOTAS_PAGADAS}{log_row_to_write}"
-        logger.info(f"Logging payment to row {log_row_to_write}, range {log_range_to_update}.")
+        log_entry_data = _build_log_row(credit_data, cantidad_cuotas_pagadas, datetime.now())
+        cuotas_abonadas_actualizadas = credit_data.get("cuotas_abonadas_antes", 0) + cantidad_cuotas_pagadas
+
+        # Append after the last row of the log table (A:I)
+        log_table_range = f"{COL_LOG_FECHA}1:{COL_LOG_CANT_CUOTAS_PAGADAS}1"
+        logger.info(f"Appending payment to log table {log_table_range}.")
         logger.debug(f"Log data: {log_entry_data}")
-        sheet.update(log_range_to_update, [log_entry_data], value_input_option='USER_ENTERED')
-        logger.info(f"Payment successfully logged for Articulo ID: {credit_data.get('id_articulo')} at log row {log_row_to_write}.")
+        try:
+            append_response = _append_log_row(sheet, log_entry_data, log_table_range)
+            # e.g. "'Sheet1'!A42:I42" -> 42
+            updated_range = append_response["updates"]["updatedRange"]
+            log_row_written = a1_to_rowcol(updated_range.split("!")[-1].split(":")[0])[0]
 
+            # The append API can't be batched with other writes, so the master record goes in its own update.
+            # The log row already exists at this point: a failure here must say so, not look like a failed payment.
+            try:
+                _update_cuotas_abonadas(sheet, master_row_index, cuotas_abonadas_actualizadas)
+            except Exception as e:
+                if isinstance(e, gspread.exceptions.APIError):
+                    reset_sheet_connection()
+                err_msg = (
+                    f"Payment was logged at log row {log_row_written}, but Cuotas Abonadas of master row {master_row_index} "
+                    f"could not be set to {cuotas_abonadas_actualizadas}: {e}"
+                )
+                logger.critical(f"{err_msg}. Master record needs a manual fix; the payment must not be logged again.", exc_info=True)
+                raise MasterUpdateError(err_msg, log_row_written, master_row_index, cuotas_abonadas_actualizadas) from e
+        finally:
+            # Cleared once the writes are done (or failed), not before them: a search running
+            # while they are in flight (or sleeping in a retry) would re-cache the old Cuotas Abonadas
+            invalidate_master_cache()
+        logger.info(
+            f"Payment successfully logged for Articulo ID: {credit_data.get('id_articulo')} at log row {log_row_written}, "
+            f"master row {master_row_index} now has {cuotas_abonadas_actualizadas} installment(s) paid."
+        )
+        return log_row_written
+
+    except MasterUpdateError:
+        raise # Already logged with the details needed to reconcile
     except gspread.exceptions.APIError as e:
         err_msg = f"Google Sheets API Error during payment logging: {e}"
         logger.error(err_msg, exc_info=True)
+        reset_sheet_connection()
         raise ConnectionError(err_msg)
     except Exception as e:
         err_msg = f"Unexpected error during payment logging: {e}"
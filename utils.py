@@ -5,6 +5,10 @@ import logging
 # ---- Logger setup ----
 logger = logging.getLogger(__name__)
 
+# ---- Precompiled patterns ----
+# Letters (Unicode), numbers, spaces, hyphens. Adjust as needed for more specific validation.
+_GENERAL_TEXT_RE = re.compile(r"^[-\w\s]+$", re.UNICODE)
+
 # ---- Text functions ----
 def normalize_text(text: str) -> str:
     """
@@ -14,6 +18,9 @@ def normalize_text(text: str) -> str:
     if not isinstance(text, str):
         logger.warning(f"normalize_text received non-string input: {type(text)}. Returning as is.")
         return str(text)
+    if text.isascii():
+        # Nothing to strip: ASCII has no diacritics, and NFKD leaves it unchanged
+        return text.lower()
     try:
         # Decompose into base characters and diacritics
         nfkd_form = unicodedata.normalize('NFKD', text)
@@ -30,7 +37,5 @@ def validate_general_text_input(response: str) -> bool:
     """
     if not isinstance(response, str):
         return False
-    # Allows letters (Unicode), numbers, spaces, hyphens.
-    # Adjust regex as needed for more specific validation.
-    return re.match(r"^[-\w\s]+$", response, re.UNICODE) is not None
+    return _GENERAL_TEXT_RE.match(response) is not None
   